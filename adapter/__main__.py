@@ -12,55 +12,77 @@ Dataflow Schematic:
 
                                    Sublime Text
                                         |
-                        -----------> Debugger -----------
-                        \                                \
-                        \                                v
-                debugger_send_loop()                   main() ---> on_receive_from_debugger()
-                         ^                                             /          \
-                         \                           -- fwd info to --          attach?
-                   fwd debugpy response              /                                \
-                           \                     v                                  v
-                            -------  start_maya_debugging()  <--- starts ---  attach_to_maya()
-                                        ^           /                               \
-                                        res       req                                \
-                                          \      v                                   v
-                                        debugpy (in Maya)                   injects debugpy in Maya
+                         ------------ Debugger <------------
+                        | stdin                     stdout  |
+                        v                                   |
+             DebuggerInterface reader           DebuggerInterface writer
+                    (thread)                            (thread)
+                        |                                   ^
+                        v                                   | interface.send()
+            on_receive_from_debugger()                      |
+               /                  \                         |
+           attach?          send_to_debugpy()               |
+              |                    |                        |
+              v                    v                        |
+       attach_to_maya()    debugpy_send_queue               |
+          (thread)                 |                        |
+          /      \    - - - - - - -|- - - event loop (main thread) - - -
+         v        \                v                        |
+  injects debugpy  --- starts ---> start_debugging()        |
+  in Maya through                  |                        |
+  its commandPort                  v                        |
+                          debugpy_send_loop()     on_receive_from_debugpy()
+                                   \                        ^
+                                   req                     res
+                                     v                     /
+                                   debugpy (in Maya) ---> DebugpyProtocol
 
 
 """
 
 from interface import DebuggerInterface
-from tempfile import gettempdir
-from queue import Queue
+from base64 import b64encode
 from util import *
+import threading
+import logging
+import asyncio
 import socket
-import json
 import os
 
 
 # Globals
 interface = None
 
-processed_seqs = []
+processed_seqs = set()
 
-maya_cmd_socket = socket.socket()
+maya_cmd_socket = None
 run_code = ""
 
-debugpy_send_queue = Queue()
-debugpy_socket = None
+loop = None
+debugpy_send_queue = None
+debugpy_send_slots = threading.Semaphore(SEND_QUEUE_SIZE)  # Bounds the send queue
+debugpy_gone = threading.Event()
+debugpy_transport = None
+debugpy_protocol = None
 
 
 def main():
     """
-    Starts the thread to send information to debugger, then remains in a loop
-    reading messages from debugger.
+    Starts the interface with the debugger in the background, then runs the
+    event loop handling all communications with debugpy.
     """
     
-    global interface
+    global interface, loop, debugpy_send_queue
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    debugpy_send_queue = asyncio.Queue()
 
     # Create and start the interface with the debugger
     interface = DebuggerInterface(on_receive=on_receive_from_debugger)
-    interface.start()
+    interface.start_nonblocking()
+
+    loop.run_forever()
 
 
 def on_receive_from_debugger(message):
@@ -69,51 +91,90 @@ def on_receive_from_debugger(message):
     while debugpy is being set up
     """
 
-    # Load message contents into a dictionary
-    contents = json.loads(message)
-
     log('Received from Debugger:', message)
 
+    # Only initialize and attach requests need to be looked at, everything
+    # else is forwarded to debugpy as is, without being parsed
+    if not INTERCEPTED_COMMAND.search(message):
+        send_to_debugpy(message)
+        return
+
+    # Load message contents into a dictionary
+    contents = json_loads(message)
+
     # Get the type of command the debugger sent
     cmd = contents['command']
     
     if cmd == 'initialize':
         # Run init request once maya connection is established and send success response to the debugger
-        interface.send(json.dumps(json.loads(INITIALIZE_RESPONSE)))  # load and dump to remove indents
-        processed_seqs.append(contents['seq'])
+        interface.send(INITIALIZE_RESPONSE_BYTES)
+        processed_seqs.add(contents['seq'])
     
     elif cmd == 'attach':
         # time to attach to maya
-        run_in_new_thread(attach_to_maya, (contents,))
+        config = contents['arguments']
+        run_in_new_thread(attach_to_maya, (config,))
 
         # Change arguments to valid ones for debugpy
-        config = contents['arguments']
-        new_args = ATTACH_ARGS.format(
-            dir=dirname(config['program']).replace('\\', '\\\\'),
-            hostname=config['debugpy']['host'],
-            port=int(config['debugpy']['port']),
-            filepath=config['program'].replace('\\', '\\\\')
-        )
+        program_dir = dirname(config['program'])
+        new_args = {
+            "name": "Maya Python Debugger : Remote Attach",
+            "type": "python",
+            "request": "attach",
+            "port": int(config['debugpy']['port']),
+            "host": config['debugpy']['host'],
+            "pathMappings": [
+                {
+                    "localRoot": program_dir,
+                    "remoteRoot": program_dir
+                }
+            ],
+            "MayaDebugFile": config['program']
+        }
 
         # Update the message with the new arguments to then be sent to debugpy
-        contents = contents.copy()
-        contents['arguments'] = json.loads(new_args)
-        message = json.dumps(contents)  # update contents to reflect new args
+        contents['arguments'] = new_args
+        message = json_dumps(contents)  # update contents to reflect new args
 
-        log("New attach arguments loaded:", new_args)
+        log("New attach arguments loaded:", message)
 
     # Then just put the message in the maya debugging queue
-    debugpy_send_queue.put(message)
+    send_to_debugpy(message)
 
 
-def attach_to_maya(contents):
+def send_to_debugpy(message):
+    """
+    Queues a message to be sent to debugpy from a thread other than the event loop's.
+    Blocks while the queue is full, and drops the message once debugpy is gone
+    """
+
+    debugpy_send_slots.acquire()
+    if debugpy_gone.is_set():
+        # Nothing takes messages off the queue anymore, don't wait for room
+        debugpy_send_slots.release()
+        log("Debugpy is gone, dropping message:", message)
+        return
+
+    loop.call_soon_threadsafe(debugpy_send_queue.put_nowait, message)
+
+
+def stop_sending_to_debugpy():
+    """
+    Makes send_to_debugpy drop messages instead of queuing them,
+    waking it up if it is waiting for room in the queue
+    """
+
+    debugpy_gone.set()
+    debugpy_send_slots.release()
+
+
+def attach_to_maya(config):
     """
     Defines commands to send to Maya, establishes a connection to its commandPort,
     then sends the code to inject debugpy
     """
 
-    global run_code
-    config = contents['arguments']
+    global run_code, maya_cmd_socket
 
     # Format the simulated attach response to send it back to the debugger
     # while we set up the debugpy in the background
@@ -123,20 +184,21 @@ def attach_to_maya(contents):
         port=int(config['debugpy']['port'])
     )
 
-    # Format RUN_TEMPLATE to point to the temporary
-    # file containing the code to run
+    # Format RUN_TEMPLATE to import or reload
+    # the module containing the code to run
     run_code = RUN_TEMPLATE.format(
         dir=dirname(config['program']),
         file_name=split(config['program'])[1][:-3] or basename(split(config['program'])[0])[:-3]
     )
 
-    log("RUN: \n" + run_code)
+    if logger.isEnabledFor(logging.DEBUG):
+        log("RUN: \n" + run_code)
 
     # Connect to given host/port combo
     maya_host, maya_port = config['maya']['host'], int(config['maya']['port'])
     try:
-        maya_cmd_socket.settimeout(3)
-        maya_cmd_socket.connect((maya_host, maya_port))
+        maya_cmd_socket = socket.create_connection((maya_host, maya_port), timeout=3)
+        maya_cmd_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     except:
         # Raising exceptions shows the text in the Debugger's output.
         # Raise an error to show a potential solution to this problem.
@@ -156,128 +218,199 @@ def attach_to_maya(contents):
     send_code_to_maya(attach_code)
     log('Successfully attached to Maya')
 
-    # Then start the maya debugging threads
-    run_in_new_thread(start_debugging, ((config['debugpy']['host'], int(config['debugpy']['port'])),))
+    # Then start debugging maya in the event loop
+    asyncio.run_coroutine_threadsafe(
+        start_debugging((config['debugpy']['host'], int(config['debugpy']['port']))),
+        loop
+    )
 
 
 def send_code_to_maya(code):
     """
-    Wraps the code string in a mel command, then sends it to Maya
+    Encodes the code string in a mel command, then sends it to Maya
     """
 
-    # Create a temporary file, keeping its path, and
-    # populate it with the given code to run
-    filepath = join(gettempdir(), 'temp.py')
-    with open(filepath, "w") as file:
-        file.write(code)
-
-    # Format the mel command to execute the temporary file
+    # Format the mel command to execute the code inline
     cmd = EXEC_COMMAND.format(
-        tmp_file_path=filepath.replace('\\', '\\\\\\\\')
+        code=b64encode(code.encode('UTF-8')).decode('ascii')
     )
 
     # Send the code to maya through the maya socket
-    log("Sending " + cmd + " to Maya")
-    maya_cmd_socket.send(cmd.encode('UTF-8'))
+    if logger.isEnabledFor(logging.DEBUG):
+        log("Sending " + cmd + " to Maya")
+    maya_cmd_socket.sendall(cmd.encode('ascii'))
 
 
-def start_debugging(address):
+async def start_debugging(address):
     """
-    Connects to debugpy in Maya, then starts the threads needed to
-    send and receive information from it
+    Connects to debugpy in Maya, then sends the queued requests to it
+    while DebugpyProtocol handles its responses
     """
 
     log("Connecting to " + address[0] + ":" + str(address[1]))
 
-    # Create the socket used to communicate with debugpy
-    global debugpy_socket
-    debugpy_socket = socket.create_connection(address)
+    # Create the connection used to communicate with debugpy
+    global debugpy_transport, debugpy_protocol
+    try:
+        debugpy_transport, debugpy_protocol = await loop.create_connection(DebugpyProtocol, *address)
+    except OSError as e:
+        log("Failure connecting to maya's debugpy: \n" + str(e))
+        stop_sending_to_debugpy()
+        return
 
     log("Successfully connected to Maya for debugging. Starting...")
 
-    # Start a thread that sends requests to debugpy
-    run_in_new_thread(debugpy_send_loop)
+    await debugpy_send_loop()
 
-    fstream = debugpy_socket.makefile()
 
-    while True:
-        try:
-            # Wait for the CONTENT_HEADER to show up,
+class DebugpyProtocol(asyncio.BufferedProtocol):
+    """
+    Reads the DAP messages sent by debugpy into a single buffer,
+    calling on_receive_from_debugpy for each complete message
+    """
+
+    def __init__(self):
+        # The buffer is reused for every message and only grows when one doesn't fit.
+        # Only keep track of where the unprocessed data starts and ends
+        self.buf = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+        # Cleared while the transport's write buffer is full
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buf):
+            if self.start > 0:
+                # Move the partially received message to the front of the buffer
+                self.view[:self.end - self.start] = self.view[self.start:self.end]
+            else:
+                # The message doesn't fit, move it to a bigger buffer
+                self.buf = bytearray(len(self.buf) * 2)
+                self.buf[:self.end] = self.view[:self.end]
+                self.view = memoryview(self.buf)
+
+            self.end -= self.start
+            self.start = 0
+
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+        # Handle every complete message in the buffer
+        while True:
+            # Wait for the end of the header to show up,
             # then get the length of the content following it
-            content_length = 0
-            while True:
-                header = fstream.readline()
-                if header:
-                    header = header.strip()
-                if not header:
-                    break
-                if header.startswith(CONTENT_HEADER):
-                    content_length = int(header[len(CONTENT_HEADER):])
-
-            # Read the content of the response, then call the callback
-            if content_length > 0:
-                total_content = ""
-                while content_length > 0:
-                    content = fstream.read(content_length)
-                    content_length -= len(content)
-                    total_content += content
-
-                if content_length == 0:
-                    message = total_content
-                    on_receive_from_debugpy(message)
-
-        except Exception as e:
-            # Problem with socket. Close it then return
-
-            log("Failure reading maya's debugpy output: \n" + str(e))
-            debugpy_socket.close()
-            break
-
-
-def debugpy_send_loop():
+            header_end = self.buf.find(b'\r\n\r\n', self.start, self.end)
+            if header_end < 0:
+                break
+            # The content header is usually the only one, but other fields may come first
+            if self.buf.startswith(CONTENT_HEADER_BYTES, self.start):
+                length_start = self.start
+            else:
+                length_start = self.buf.find(b'\r\n' + CONTENT_HEADER_BYTES, self.start, header_end) + 2
+                if length_start < 2:
+                    raise ValueError("Missing content header from debugpy")
+            length_start += len(CONTENT_HEADER_BYTES)
+
+            # Other fields may also follow it
+            length_end = self.buf.find(b'\r\n', length_start, header_end)
+            if length_end < 0:
+                length_end = header_end
+            content_length = int(self.buf[length_start:length_end])
+
+            # Wait for the whole content of the response, then call the callback
+            body_start = header_end + 4
+            body_end = body_start + content_length
+            if body_end > self.end:
+                break
+
+            self.start = body_end
+            on_receive_from_debugpy(self.view[body_start:body_end])
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def connection_lost(self, exc):
+        # Problem with socket, stop sending to it
+        log("Failure reading maya's debugpy output: \n" + str(exc or "Connection closed by debugpy"))
+        self.can_write.set()
+        debugpy_send_queue.put_nowait(None)
+
+
+async def debugpy_send_loop():
     """
-    The loop that waits for items to show in the send queue and prints them.
-    Blocks until an item is present
+    The loop that waits for items to show in the send queue and sends them.
+    Waits until an item is present, then sends every queued item at once
     """
 
     while True:
-        # Get the first message off the queue
-        msg = debugpy_send_queue.get()
-        if msg is None:
-            # get() is blocking, so None means it was intentionally
-            # added to the queue to stop this loop, or that a problem occurred
+        # Get the first message off the queue, along with any other queued message
+        msgs = [await debugpy_send_queue.get()]
+        while len(msgs) < SEND_BATCH_SIZE and not debugpy_send_queue.empty():
+            msgs.append(debugpy_send_queue.get_nowait())
+
+        # Wait for debugpy to catch up if the transport's buffer is full
+        await debugpy_protocol.can_write.wait()
+
+        frames = []
+        closed = debugpy_transport.is_closing()
+        for msg in msgs:
+            if msg is None:
+                # None means it was intentionally added to the
+                # queue to stop this loop, or that a problem occurred
+                closed = True
+                break
+
+            # Messages forwarded untouched from the debugger are still strings
+            if isinstance(msg, str):
+                msg = msg.encode('UTF-8')
+
+            # The content header with the length of the message followed by the message
+            frames.append(MESSAGE_TEMPLATE % (len(msg), msg))
+
+        if closed:
+            log("Debug socket closed.")
+            stop_sending_to_debugpy()
             return
-        else:
-            try:
-                # First send the content header with the length of the message, then send the message
-                debugpy_socket.send(bytes(CONTENT_HEADER + '{}\r\n\r\n'.format(len(msg)), 'UTF-8'))
-                debugpy_socket.send(bytes(msg, 'UTF-8'))
-                log('Sent to debugpy:', msg)
-            except OSError:
-                log("Debug socket closed.")
-                return
+
+        debugpy_transport.write(b''.join(frames))
+        for msg in msgs:
+            debugpy_send_slots.release()
+            log('Sent to debugpy:', msg)
 
 
 def on_receive_from_debugpy(message):
     """
-    Handles messages going from debugpy to the debugger
+    Handles messages going from debugpy to the debugger.
+    The message is a view of the receive buffer, only valid during this call
     """
 
     # Load the message into a dictionary
-    c = json.loads(message)
+    c = json_loads(message)
     seq = int(c.get('request_seq', -1))  # a negative seq will never occur
     cmd = c.get('command', '')
 
     if cmd == 'configurationDone':
-        # When Debugger & debugpy are done setting up, send the code to debug
-        send_code_to_maya(run_code)
+        # When Debugger & debugpy are done setting up, send the code to debug.
+        # Maya's socket is blocking, so keep it off the event loop
+        run_in_new_thread(send_code_to_maya, (run_code,))
 
     # Send responses and events to debugger
     if seq in processed_seqs:
         # Should only be the initialization request
-        log("Already processed, debugpy response is:", message)
+        log("Already processed, debugpy response is:", bytes(message))
     else:
-        # Send the message normally to the debugger
+        # Copy the message out of the receive buffer, then send it normally to the debugger
+        message = bytes(message)
         log('Received from debugpy:', message)
         interface.send(message)
 
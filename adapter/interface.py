@@ -1,7 +1,7 @@
 
 from sys import stdin, stdout
 from queue import Queue
-from util import CONTENT_HEADER, run_in_new_thread, log
+from util import CONTENT_HEADER, MESSAGE_TEMPLATE, run_in_new_thread, log
 
 
 class DebuggerInterface:
@@ -81,9 +81,12 @@ class DebuggerInterface:
                 return
             else:
                 try:
-                    stdout.write('Content-Length: {}\r\n\r\n'.format(len(msg)))
-                    stdout.write(msg)
-                    stdout.flush()
+                    # Messages can either be strings or UTF-8 encoded bytes
+                    if isinstance(msg, str):
+                        msg = msg.encode('UTF-8')
+
+                    stdout.buffer.write(MESSAGE_TEMPLATE % (len(msg), msg))
+                    stdout.buffer.flush()
                     log('Sent to Debugger:', msg)
                 except Exception as e:
                     log("Failure writing to stdout (normal on exit):" + str(e))
@@ -1,9 +1,12 @@
 
+from logging.handlers import QueueHandler, QueueListener
 from os.path import abspath, join, dirname, basename, split
 from threading import Timer
-from datetime import datetime
+import logging
+import atexit
 import json
 import sys
+import re
 
 
 # Import correct Queue
@@ -12,27 +15,82 @@ if (sys.version_info[0] == 3):
 else:  # Python 2
     from multiprocessing import Queue
 
+# Use orjson when it is available, falling back to the standard json module.
+# Both json_loads and json_dumps work with UTF-8 encoded bytes.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    def json_loads(msg):
+        if not isinstance(msg, str):
+            msg = bytes(msg).decode('UTF-8')
+        return json.loads(msg)
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('UTF-8')
+
 #  Debugging this adapter
 debug = True
 debug_no_maya = False
 log_file = abspath(join(dirname(__file__), 'log.txt'))
 
+debugpy_path = join(abspath(dirname(__file__)), "python")
+
+
+# --- Logging --- #
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues log records as they are, leaving their formatting
+    to the listener's thread instead of the thread logging them
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class PrettyJson:
+    """
+    Wraps a json message that only gets indented when the log record is formatted
+    """
+
+    def __init__(self, json_msg):
+        self.json_msg = json_msg
+
+    def __str__(self):
+        return json.dumps(json_loads(self.json_msg), indent=4)
+
+
+logger = logging.getLogger('mayapy_adapter')
+logger.propagate = False
+
 if debug:
-    open(log_file, 'w+').close()  # Creates and/or clears the file
+    # Records are written to the log file from a background thread
+    log_handler = logging.FileHandler(log_file, mode='w')  # Creates and/or clears the file
+    log_handler.setFormatter(logging.Formatter('\n%(asctime)s - %(message)s', "%Y-%m-%d %H:%M:%S"))
 
-debugpy_path = join(abspath(dirname(__file__)), "python")
+    log_listener = QueueListener(Queue(), log_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    logger.addHandler(DeferredQueueHandler(log_listener.queue))
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
 
 
 # --- Utility functions --- #
 
 def log(msg, json_msg=None):
-    if debug:
+    if logger.isEnabledFor(logging.DEBUG):
 
         if json_msg:
-            msg += '\n' + json.dumps(json.loads(json_msg), indent=4)
-
-        with open(log_file, 'a+') as f:
-            f.write('\n' + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + msg + '\n')
+            logger.debug('%s\n%s', msg, PrettyJson(json_msg))
+        else:
+            logger.debug(msg)
 
 
 def run_in_new_thread(func, args=None, time=0.01):
@@ -81,6 +139,20 @@ except Exception as e:
 """
 
 CONTENT_HEADER = "Content-Length: "
+CONTENT_HEADER_BYTES = CONTENT_HEADER.encode('ascii')
+
+# Formats a DAP message from its length and UTF-8 encoded content
+MESSAGE_TEMPLATE = CONTENT_HEADER_BYTES + b'%d\r\n\r\n%s'
+
+# Initial size of the buffer messages from debugpy are read into
+RECV_BUFFER_SIZE = 65536
+
+# Maximum number of messages waiting to be sent to debugpy, and sent to it at once
+SEND_QUEUE_SIZE = 1024
+SEND_BATCH_SIZE = 64
+
+# Finds the requests intercepted by the adapter without having to parse the whole message
+INTERCEPTED_COMMAND = re.compile(r'"command"\s*:\s*"(?:initialize|attach)"')
 
 INITIALIZE_RESPONSE = """{
     "request_seq": 1,
@@ -121,22 +193,11 @@ INITIALIZE_RESPONSE = """{
     "type": "response"
 }"""
 
-ATTACH_ARGS = """{{
-    "name": "Maya Python Debugger : Remote Attach",
-    "type": "python",
-    "request": "attach",
-    "port": {port},
-    "host": "{hostname}",
-    "pathMappings": [
-        {{
-            "localRoot": "{dir}",
-            "remoteRoot": "{dir}"
-        }}
-    ],
-    "MayaDebugFile": "{filepath}"
-}}"""
+# Minified once, as sent to the debugger
+INITIALIZE_RESPONSE_BYTES = json_dumps(json_loads(INITIALIZE_RESPONSE))
 
-EXEC_COMMAND = """python("execfile('{tmp_file_path}')")"""
+# Executes base64 encoded python code in Maya, avoiding any escaping of the code itself
+EXEC_COMMAND = """python("exec(__import__('base64').b64decode('{code}').decode('UTF-8'))")"""
 
 PAUSE_REQUEST = """{{
     "command": "pause",
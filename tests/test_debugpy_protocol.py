@@ -0,0 +1,89 @@
+
+"""
+
+Tests the framing of the DAP messages received from debugpy by DebugpyProtocol
+
+"""
+
+from os.path import abspath, join, dirname
+import importlib.util
+import unittest
+import json
+import sys
+
+
+adapter_path = join(dirname(abspath(__file__)), '..', 'adapter')
+sys.path.insert(0, adapter_path)
+
+spec = importlib.util.spec_from_file_location('adapter_main', join(adapter_path, '__main__.py'))
+adapter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(adapter)
+
+
+def frame(body, before=b'', after=b''):
+    """ Builds a DAP message, with optional header fields around the content header """
+    return before + b'Content-Length: %d\r\n' % len(body) + after + b'\r\n' + body
+
+
+def feed(protocol, data, chunk_size):
+    """ Feeds data to the protocol the way the transport does, at most chunk_size bytes at a time """
+    while data:
+        buf = protocol.get_buffer(-1)
+        size = min(len(buf), chunk_size, len(data))
+        buf[:size] = data[:size]
+        protocol.buffer_updated(size)
+        data = data[size:]
+
+
+class TestDebugpyProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.on_receive = adapter.on_receive_from_debugpy
+        adapter.on_receive_from_debugpy = lambda message: self.received.append(bytes(message))
+        self.protocol = adapter.DebugpyProtocol()
+
+    def tearDown(self):
+        adapter.on_receive_from_debugpy = self.on_receive
+
+    def bodies(self, count, size):
+        return [
+            json.dumps({"seq": i, "body": {"output": "é" * (size + i % 7)}}).encode('UTF-8')
+            for i in range(count)
+        ]
+
+    def test_single_bytes(self):
+        bodies = self.bodies(3, 10)
+        feed(self.protocol, b''.join(frame(b) for b in bodies), 1)
+        self.assertEqual(self.received, bodies)
+
+    def test_odd_sized_chunks(self):
+        # Small messages adding up to more than the buffer must be compacted, not grown
+        bodies = self.bodies(500, 200)
+        feed(self.protocol, b''.join(frame(b) for b in bodies), 4099)
+        self.assertEqual(self.received, bodies)
+        self.assertEqual(len(self.protocol.buf), adapter.RECV_BUFFER_SIZE)
+
+    def test_larger_than_buffer(self):
+        bodies = self.bodies(1, adapter.RECV_BUFFER_SIZE) + self.bodies(2, 10) + self.bodies(1, adapter.RECV_BUFFER_SIZE * 3)
+        feed(self.protocol, b''.join(frame(b) for b in bodies), adapter.RECV_BUFFER_SIZE * 2)
+        self.assertEqual(self.received, bodies)
+
+    def test_other_header_fields(self):
+        bodies = self.bodies(4, 10)
+        data = (
+            frame(bodies[0]) +
+            frame(bodies[1], before=b'X-Before: 1\r\n') +
+            frame(bodies[2], after=b'Content-Type: application/json\r\n') +
+            frame(bodies[3], before=b'A: 1\r\n', after=b'B: 2\r\n')
+        )
+        feed(self.protocol, data, 3)
+        self.assertEqual(self.received, bodies)
+
+    def test_missing_content_header(self):
+        with self.assertRaises(ValueError):
+            feed(self.protocol, b'X-Other: 2\r\n\r\n{}', 64)
+
+
+if __name__ == '__main__':
+    unittest.main()